@@ -1,31 +1,84 @@
 import gevent
 import gevent.baseserver
 import gevent.event
-import gevent.timeout
-import gevent.pool
 import gevent.util
 from gservice.util import defaultproperty
 
 import functools
+import sys
+import weakref
 
 NOT_READY = 1
 
 def require_ready(func):
     @functools.wraps(func)
     def wrapped(self, *args, **kwargs):
-        try:
-            self._ready_event.wait(self.ready_timeout)
-        except gevent.timeout.Timeout, e:
-            pass
+        if self.ready:
+            return func(self, *args, **kwargs)
+        with gevent.Timeout(self.ready_timeout, False):
+            self._ready_event.wait()
         if not self.ready:
             raise RuntimeWarning("Service must be ready to call this method.")
         return func(self, *args, **kwargs)
     return wrapped
 
+def _call_handlers(exception, handler_list, exc_types):
+    """Call the error handlers matching an exception
+    
+    Exceptions raised by a handler are dispatched to their own matching
+    handlers before the next handler runs, using an explicit stack rather
+    than re-wrapping each handler. A handler is never called again for an
+    exception raised, directly or not, by itself; if no other handler
+    matches, that exception propagates out of the greenlet instead.
+    
+    """
+    # each frame is [error, traceback, seen handlers, pending entries, matched]
+    stack = [[exception, None, (), iter(handler_list), False]]
+    while stack:
+        frame = stack[-1]
+        error, traceback, seen, pending = frame[:4]
+        for exc_type, handler, greenlet in pending:
+            if isinstance(error, exc_type) and handler not in seen:
+                frame[4] = True
+                try:
+                    handler(error, greenlet)
+                except exc_types, nested:
+                    stack.append([nested, sys.exc_info()[2], seen + (handler,),
+                                  iter(handler_list), False])
+                    break
+        else:
+            stack.pop()
+            if traceback is not None and not frame[4]:
+                raise type(error), error, traceback
+
+class _WrappedCall(object):
+    """Callable running `func` with error handlers, used by Service.spawn
+    
+    A slotted object is cheaper to create per spawn than a closure.
+    Only the name of `func` is kept, for greenlet reprs and debugging.
+    
+    """
+    __slots__ = ('func', 'handler_list', 'exc_types', '__name__')
+
+    def __init__(self, func, handler_list, exc_types):
+        self.func = func
+        self.handler_list = handler_list
+        self.exc_types = exc_types
+        self.__name__ = getattr(func, '__name__', 'wrapped_f')
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return self.func(*args, **kwargs)
+        except self.exc_types, exception:
+            _call_handlers(exception, self.handler_list, self.exc_types)
+            return exception
+
 class NamedService(object):
     def __init__(self, name, use_dict):
         self.name = name
         self.use_dict = use_dict
+        self._cached = None
+        self._cached_version = None
 
     def __get__(self, instance, owner):
         return self.value
@@ -35,7 +88,20 @@ class NamedService(object):
 
     @property
     def value(self):
-        return Service._get_named_service(self.name, self.use_dict)
+        """The named service, cached until the next registration
+        
+        Only :meth:`Service.register_named_service` invalidates the cache;
+        replacing or deleting entries in the lookup dictionary directly is
+        not seen by lookups that already found a service.
+        
+        """
+        version = Service._named_version
+        if self._cached is not None and self._cached_version == version:
+            return self._cached
+        service = Service._get_named_service(self.name, self.use_dict)
+        self._cached = service
+        self._cached_version = version
+        return service
 
     @value.setter
     def setvalue(self, value):
@@ -64,21 +130,69 @@ class Service(object):
     started = defaultproperty(bool, False)
     
     _children = defaultproperty(list)
+    # reversed view of _children for stop, reset by add/remove_service
+    _children_reversed = None
     _stopped_event = defaultproperty(gevent.event.Event)
     _ready_event = defaultproperty(gevent.event.Event)
-    _greenlets = defaultproperty(gevent.pool.Group)
+    _greenlets = defaultproperty(set)
+    _greenlet_class = gevent.Greenlet
     _error_handlers = defaultproperty(dict)
+    _error_handler_list = defaultproperty(list)
+    _handler_types = defaultproperty(tuple)
 
     # main services dictionary for looking up named services
     _main_services = {}
+    # bumped on every registration to invalidate NamedService lookups
+    _named_version = 0
 
     @classmethod
     def register_named_service(cls, name, service, use_dict=_main_services):
+        """Register `service` under `name`
+        
+        Always register named services through this method rather than
+        writing to the dictionary, so cached lookups are invalidated.
+        
+        """
         use_dict[name] = service
+        Service._named_version += 1
+
+    # wrappers used by add_service, keyed by the class they wrap; the
+    # per-class cache has weak keys so child classes can still be collected
+    _wrappers = {}
+    _wrapper_cache = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def register_wrapper(cls, klass, wrapper):
+        """Wrap instances of `klass` with `wrapper` when added as children"""
+        Service._wrappers[klass] = wrapper
+        Service._wrapper_cache.clear()
+
+    @classmethod
+    def unregister_wrapper(cls, klass):
+        """Stop wrapping instances of `klass` added as children"""
+        Service._wrappers.pop(klass, None)
+        Service._wrapper_cache.clear()
+
+    @classmethod
+    def _get_wrapper(cls, klass):
+        try:
+            return Service._wrapper_cache[klass]
+        except KeyError:
+            # the most specific registered class wins
+            wrapper = None
+            for kls in klass.__mro__:
+                if kls in Service._wrappers:
+                    wrapper = Service._wrappers[kls]
+                    break
+            Service._wrapper_cache[klass] = wrapper
+            return wrapper
 
     @classmethod
     def _get_named_service(cls, name, use_dict=_main_services):
-        return use_dict.get(name, None)
+        try:
+            return use_dict[name]
+        except KeyError:
+            return None
 
     def __new__(cls, *args, **kwargs):
         """
@@ -112,61 +226,86 @@ class Service(object):
         
         The service added will be started when this service starts, before 
         its :meth:`_start` method is called. It will also be stopped when this 
-        service stops, before its :meth:`_stop` method is called.
+        service stops, before its :meth:`_stop` method is called. Gevent
+        servers, and any other class given to :meth:`register_wrapper`,
+        are wrapped so every child is a Service. Children must be added
+        through this method rather than by assigning to `_children`, as
+        raw gevent servers can no longer be started directly.
         
         """
-        if isinstance(service, gevent.baseserver.BaseServer):
-            service = ServiceWrapper(service)
+        wrapper = Service._get_wrapper(type(service))
+        if wrapper is not None:
+            service = wrapper(service)
         self._children.append(service)
+        self._children_reversed = None
     
     def remove_service(self, service):
         """Remove a child service from this service"""
         self._children.remove(service)
+        self._children_reversed = None
     
     def _wrap_errors(self, func):
         """Wrap a callable for triggering error handlers
         
         This is used by the greenlet spawn methods so you can handle known
         exception cases instead of gevent's default behavior of just printing
-        a stack trace for exceptions running in parallel greenlets.
+        a stack trace for exceptions running in parallel greenlets. The
+        handled exception types are captured when the callable is wrapped,
+        and callables are returned untouched if no handlers are registered.
         
         """
-        @functools.wraps(func)
-        def wrapped_f(*args, **kwargs):
-            exceptions = tuple(self._error_handlers.keys())
-            try:
-                return func(*args, **kwargs)
-            except exceptions, exception:
-                for type in self._error_handlers:
-                    if isinstance(exception, type):
-                        handler, greenlet = self._error_handlers[type]
-                        self._wrap_errors(handler)(exception, greenlet)
-                return exception
-        return wrapped_f
+        if not self._error_handlers:
+            return func
+        return _WrappedCall(func, self._error_handler_list,
+                            self._handler_types)
     
     def catch(self, type, handler):
         """Set an error handler for exceptions.
         
         Catches exceptions of `type` raised in greenlets for this service
-        and recursively any existing child services.
+        and any existing child services, walking the tree iteratively.
         """
-        self._error_handlers[type] = (handler, gevent.getcurrent())
-        for child in self._children:
-            child.catch(type, handler)
+        greenlet = gevent.getcurrent()
+        stack = [self]
+        while stack:
+            service = stack.pop()
+            service._set_error_handler(type, handler, greenlet)
+            stack.extend(service._children)
+    
+    def _set_error_handler(self, type, handler, greenlet):
+        """Register a handler on this service only"""
+        self._error_handlers[type] = (handler, greenlet)
+        # copied rather than mutated, so already wrapped callables keep
+        # the handlers that match their exception types
+        entry = (type, handler, greenlet)
+        handler_list = list(self._error_handler_list)
+        for i, (exc_type, _, _) in enumerate(handler_list):
+            if exc_type == type:
+                handler_list[i] = entry
+                break
+        else:
+            handler_list.append(entry)
+        self._error_handler_list = handler_list
+        self._handler_types = tuple(exc_type for exc_type, _, _ in handler_list)
+    
+    def _track(self, g):
+        """Keep track of a greenlet until it finishes"""
+        g._owning_service = self
+        self._greenlets.add(g)
+        g.rawlink(self._greenlets.discard)
+        return g
     
     def spawn(self, func, *args, **kwargs):
         """Spawn a greenlet under this service"""
         func_wrap = self._wrap_errors(func)
-        return self._greenlets.spawn(func_wrap, *args, **kwargs)
+        return self._track(
+            self._greenlet_class.spawn(func_wrap, *args, **kwargs))
     
     def spawn_later(self, seconds, func, *args, **kwargs):
         """Spawn a greenlet in the future under this service"""
-        group = self._greenlets
         func_wrap = self._wrap_errors(func)
-        g = group.greenlet_class(func_wrap, *args, **kwargs)
-        g.start_later(seconds)
-        group.add(g)
-        return g
+        return self._track(
+            self._greenlet_class.spawn_later(seconds, func_wrap, *args, **kwargs))
     
     def start(self, block_until_ready=True):
         """Public interface for starting this service and children. By default it blocks until ready."""
@@ -177,13 +316,11 @@ class Service(object):
         self._ready_event.clear()
         try:
             self.pre_start()
+            # add_service wraps gevent servers, so every child is a Service;
+            # raw gevent servers assigned to _children are not supported
             for child in self._children:
-                if isinstance(child, Service):
-                    if not child.started:
-                        child.start(block_until_ready)
-                elif isinstance(child, gevent.baseserver.BaseServer):
-                    if not child.started:
-                        child.start()
+                if not child.started:
+                    child.start(block_until_ready)
             ready = self.do_start()
             if ready == NOT_READY and block_until_ready is True:
                 self._ready_event.wait(self.ready_timeout)
@@ -216,12 +353,14 @@ class Service(object):
         If the server uses a pool to spawn the requests, then :meth:`stop` also waits
         for all the handlers to exit. If there are still handlers executing after *timeout*
         has expired (default 1 second), then the currently running handlers in the pool are killed."""
-        if gevent.getcurrent() in self._greenlets:
+        if getattr(gevent.getcurrent(), '_owning_service', None) is self:
             return gevent.spawn(self.stop)
         self.started = False
         try:
             self.pre_stop()
-            for child in reversed(self._children):
+            if self._children_reversed is None:
+                self._children_reversed = self._children[::-1]
+            for child in self._children_reversed:
                 #iterate over children in reverse order, in case dependancies
                 # were implied by the starting order
                 if child.started:
@@ -231,8 +370,10 @@ class Service(object):
             if timeout is None:
                 timeout = self.stop_timeout
             if self._greenlets:
-                self._greenlets.join(timeout=timeout)
-                self._greenlets.kill(block=True, timeout=1)
+                gevent.joinall(list(self._greenlets), timeout=timeout)
+            # finished greenlets unlink themselves, so only kill leftovers
+            if self._greenlets:
+                gevent.killall(list(self._greenlets), block=True, timeout=1)
             self._ready_event.clear()
             self._stopped_event.set()
             self.post_stop()
@@ -296,3 +437,5 @@ class ServiceWrapper(Service):
     
     def do_stop(self):
         self.wrapped.stop()
+
+Service.register_wrapper(gevent.baseserver.BaseServer, ServiceWrapper)
@@ -18,13 +18,12 @@ class RootService(gservice.core.Service):
 
         main is the main service for this daemon
         """
-        self._children = []
         for name, service in children:
-            self._children.append(service)
+            self.add_service(service)
             gservice.core.Service.register_named_service(name=name,
                 service=service)
         # and append main_service so that it's started last
-        self._children.append(main_service)
+        self.add_service(main_service)
         self.main_service = main_service
 
     def serve_forever(self, stop_timeout=None, ready_callback=None):
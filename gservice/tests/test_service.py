@@ -83,6 +83,64 @@ def test_greenlet_exception_catching_service():
     s.start()
     s.stop() # Probably not run
 
+def test_handler_reraising_its_own_exception_propagates():
+    calls = []
+    def handle_io(error, greenlet):
+        calls.append('io')
+        raise IOError("Second Error")
+
+    def run():
+        raise IOError("First Error")
+
+    s = SlowReadyService()
+    s.catch(IOError, handle_io)
+    g = s.spawn(run)
+    g.join(timeout=1)
+    assert g.ready(), "Greenlet did not finish"
+    assert calls == ['io'], "Handler was called again for its own error"
+    assert str(g.exception) == "Second Error"
+
+def test_nested_handlers_are_called_once_each():
+    calls = []
+    def handle_io(error, greenlet):
+        calls.append('io')
+        raise KeyError("nested")
+
+    def handle_key(error, greenlet):
+        calls.append('key')
+        raise IOError("cycle")
+
+    def run():
+        raise IOError("First Error")
+
+    s = SlowReadyService()
+    s.catch(IOError, handle_io)
+    s.catch(KeyError, handle_key)
+    g = s.spawn(run)
+    g.join(timeout=1)
+    assert g.ready(), "Greenlet did not finish"
+    assert calls == ['io', 'key'], "Handlers were not each called once"
+    assert str(g.exception) == "cycle"
+
+def test_nested_errors_are_handled_before_next_handler():
+    calls = []
+    def handle_io(error, greenlet):
+        calls.append('io')
+        raise KeyError("nested")
+
+    def run():
+        raise IOError("First Error")
+
+    s = SlowReadyService()
+    s.catch(IOError, handle_io)
+    s.catch(EnvironmentError, lambda e, g: calls.append('env'))
+    s.catch(KeyError, lambda e, g: calls.append('key'))
+    g = s.spawn(run)
+    g.join(timeout=1)
+    assert sorted(calls) == ['env', 'io', 'key'], "Handlers were not all called"
+    assert calls.index('key') == calls.index('io') + 1, \
+        "Nested error was not handled before the next handler"
+
 def test_service_serves_forever():
     class StoppingService(service.Service):
         def do_start(self):
@@ -183,3 +241,159 @@ def test_service_lookup_ctor():
     assert isinstance(gs.value, Foo)
     assert inits == ['hello', 'what']
     print inits
+
+def test_wrap_errors_without_handlers_is_noop():
+    def run():
+        pass
+
+    s = SlowReadyService()
+    assert s._wrap_errors(run) is run, "Callable was wrapped without handlers"
+    s.catch(IOError, lambda e, g: None)
+    assert s._wrap_errors(run) is not run, "Callable was not wrapped"
+
+def test_stop_from_own_greenlet():
+    class SelfStoppingService(service.Service):
+        def do_start(self):
+            self.stopper = self.spawn(self.stop)
+
+    s = SelfStoppingService()
+    s.start()
+    assert s.stopper._owning_service is s, "Greenlet not tagged with service"
+    s._stopped_event.wait(1)
+    assert not s.started, "Service did not stop"
+
+def test_finished_greenlets_are_discarded():
+    s = SlowReadyService()
+    g = s.spawn(lambda: None)
+    assert g in s._greenlets, "Greenlet is not tracked"
+    g.join()
+    gevent.sleep(0)
+    assert g not in s._greenlets, "Finished greenlet is still tracked"
+
+def test_named_service_lookup_follows_registration():
+    mock_dict = {}
+    gs = service.Service('cached', mock_dict=mock_dict)
+    assert gs.value is None
+    service.Service.register_named_service('cached', 1, use_dict=mock_dict)
+    assert gs.value == 1
+    service.Service.register_named_service('cached', 2, use_dict=mock_dict)
+    assert gs.value == 2
+
+def test_catch_replaces_handler_in_order():
+    s = SlowReadyService()
+    first = lambda e, g: None
+    second = lambda e, g: None
+    s.catch(IOError, first)
+    s.catch(KeyError, first)
+    s.catch(IOError, second)
+    assert [h[:2] for h in s._error_handler_list] == \
+        [(IOError, second), (KeyError, first)]
+    assert s._handler_types == (IOError, KeyError)
+
+def test_add_service_wraps_gevent_servers():
+    import gevent.server
+    s = SlowReadyService()
+    server = gevent.server.StreamServer(('127.0.0.1', 0), lambda sock, addr: None)
+    s.add_service(server)
+    assert isinstance(s._children[0], service.ServiceWrapper)
+    assert s._children[0].wrapped is server
+
+def test_children_stop_in_reverse_order():
+    stopped = []
+    class RecordingService(service.Service):
+        def do_stop(self):
+            stopped.append(self)
+
+    s = SlowReadyService()
+    first, second, third = [RecordingService() for _ in xrange(3)]
+    for child in first, second, third:
+        s.add_service(child)
+    s.start()
+    s.stop()
+    assert stopped == [third, second, first], "Children not stopped in reverse"
+
+    del stopped[:]
+    s.remove_service(second)
+    s.start()
+    s.stop()
+    assert stopped == [third, first], "Removed child was still stopped"
+
+def test_catch_applies_to_nested_children():
+    class GrandparentService(service.Service):
+        def __init__(self):
+            self.child = ParentService()
+            self.add_service(self.child)
+
+    s = GrandparentService()
+    handler = lambda e, g: None
+    s.catch(IOError, handler)
+    for node in s, s.child, s.child.child:
+        assert node._error_handlers[IOError][0] is handler, \
+            "Handler not set on %r" % node
+
+def test_add_service_uses_most_specific_wrapper():
+    import gevent.pywsgi
+    import gevent.server
+    class WSGIWrapper(service.ServiceWrapper):
+        pass
+
+    service.Service.register_wrapper(gevent.pywsgi.WSGIServer, WSGIWrapper)
+    try:
+        s = SlowReadyService()
+        handle = lambda *args: None
+        s.add_service(gevent.pywsgi.WSGIServer(('127.0.0.1', 0), handle))
+        s.add_service(gevent.server.StreamServer(('127.0.0.1', 0), handle))
+        assert type(s._children[0]) is WSGIWrapper
+        assert type(s._children[1]) is service.ServiceWrapper
+    finally:
+        service.Service.unregister_wrapper(gevent.pywsgi.WSGIServer)
+
+def test_greenlet_class_is_used_for_all_spawns():
+    class MyGreenlet(gevent.Greenlet):
+        pass
+
+    class MyGreenletService(service.Service):
+        _greenlet_class = MyGreenlet
+
+    s = MyGreenletService()
+    spawned = [s.spawn(gevent.sleep, 0), s.spawn_later(0, gevent.sleep, 0)]
+    s.catch(IOError, lambda e, g: None)
+    spawned += [s.spawn(gevent.sleep, 0), s.spawn_later(0, gevent.sleep, 0)]
+    for g in spawned:
+        assert isinstance(g, MyGreenlet), "Greenlet class was not used"
+    gevent.joinall(spawned)
+
+def test_catch_replacement_handles_later_greenlets():
+    calls = []
+    def run():
+        raise IOError("Error")
+
+    s = SlowReadyService()
+    s.catch(IOError, lambda e, g: calls.append('first'))
+    s.spawn(run).join()
+    s.catch(IOError, lambda e, g: calls.append('second'))
+    s.spawn(run).join()
+    assert calls == ['first', 'second'], "Replaced handler was still called"
+
+def test_greenlets_finishing_out_of_order_are_discarded():
+    s = SlowReadyService()
+    greenlets = [s.spawn(gevent.sleep, 1) for _ in xrange(5)]
+    greenlets[2].kill()
+    gevent.sleep(0)
+    assert s._greenlets == set(greenlets) - set([greenlets[2]])
+    gevent.killall(greenlets[::-1])
+    gevent.sleep(0)
+    assert not s._greenlets, "Finished greenlets are still tracked"
+
+def test_add_service_does_not_keep_classes_alive():
+    import gc
+    import weakref
+    class ChildService(service.Service):
+        pass
+
+    s = SlowReadyService()
+    s.add_service(ChildService())
+    ref = weakref.ref(ChildService)
+    del s, ChildService
+    gc.collect()
+    assert ref() is None, "child class was kept alive"
@@ -45,3 +45,23 @@ def test_default_subclasses_work():
     bar.bar.add(5)
 
     assert bar.bar == set([5]), "defaultproperties can find parent classes."
+
+def test_default_is_stored_on_instance():
+    Foo = _make_class(object)
+    foo = Foo()
+    bar = foo.bar
+    assert foo.__dict__['bar'] is bar, "default is set on the instance"
+    assert Foo().bar is not bar, "each instance gets its own default"
+
+def test_default_property_does_not_keep_classes_alive():
+    import gc
+    import weakref
+    from gservice.util import defaultproperty
+    prop = defaultproperty(set)
+    class Foo(object):
+        bar = prop
+    Foo().bar
+    ref = weakref.ref(Foo)
+    del Foo
+    gc.collect()
+    assert ref() is None, "owner class was kept alive"
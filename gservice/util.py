@@ -5,6 +5,7 @@ Some useful functions.
 """
 
 import random
+import weakref
 
 def line_protocol(socket_or_file, strip=True):
     """Generator for looping line-based protocol
@@ -68,14 +69,26 @@ class defaultproperty(object):
         self.default_factory = default_factory
         self.args = args
         self.kwargs = kwargs
+        # attribute name per owner class, so the mro is only searched once;
+        # weak keys so dynamically created classes can still be collected
+        self._names = weakref.WeakKeyDictionary()
+
+    def _find_name(self, owner):
+        for kls in owner.__mro__:
+            for key, value in kls.__dict__.iteritems():
+                if value is self:
+                    return key
 
     def __get__(self, instance, owner):
         if instance is None:
             return None
-        for kls in owner.__mro__:
-            for key, value in kls.__dict__.iteritems():
-                if value == self:
-                    newval = self.default_factory(*self.args, **self.kwargs)
-                    instance.__dict__[key] =newval
-                    return newval
+        try:
+            name = self._names[owner]
+        except KeyError:
+            name = self._names[owner] = self._find_name(owner)
+        if name is None:
+            return None
+        newval = self.default_factory(*self.args, **self.kwargs)
+        instance.__dict__[name] = newval
+        return newval
 